@@ -12,20 +12,143 @@ import numpy as np
 import dedalus.public as d3
 import logging
 import h5py
+import histograms
+import finite_difference
 logger = logging.getLogger(__name__)
 
-def solve(stop_sim_time,Nx=32):
-    
-    # Parameters
-    κ = 0.1;  # Equivalent to Peclet number
-    timestep = 5e-03
+def snapshot_label(t=None):
+    """Name of the snapshot group holding the stencil window at time t."""
+    if t is None:
+        return 'snapshots'
+    return ('snapshots_t%2.2f'%t).replace('.','p')
+
+class StencilSchedule:
+    """
+    Dedalus custom_schedule recording the n snapshots t_k = t + (k - n//2)*Δ,
+    k = 0,...,n-1, of a finite difference stencil centred on the time t.
+    Each t_k is recorded at the step whose sim_time lies closest to it.
+    """
+
+    def __init__(self, t, Δ, n=5):
+        self.times = t + (np.arange(n) - n//2)*Δ
+        self.k = 0
+        if self.times[0] < 0:
+            raise ValueError("Stencil about t=%g starts before t=0" % t)
+
+    @property
+    def end_time(self):
+        return self.times[-1]
+
+    def next_time(self):
+        """Next stencil time still to be recorded, None once complete."""
+        if self.k < len(self.times):
+            return self.times[self.k]
+        return None
+
+    def __call__(self, sim_time, timestep, **kw):
+        t_k = self.next_time()
+        if t_k is not None and abs(sim_time - t_k) <= abs(sim_time + timestep - t_k):
+            self.k += 1
+            return True
+        return False
+
+def check_uniform(times, rtol=1e-6):
+    """Raise a ValueError unless the snapshot times are uniformly spaced."""
+    Δ = np.diff(times)
+    if not np.allclose(Δ, Δ[0], rtol=rtol, atol=0):
+        raise ValueError("Snapshots are not uniformly spaced in time: dt = %s" % Δ)
+    return Δ[0]
+
+class InSituPDF:
+    """
+    In-situ estimates of f_Y(y), E{Φ|Y=y} and optionally f_YΦ(y,φ), Φ = |∇Y|^2,
+    computed from the local grid data every cadence iterations of solve, and at
+    its end, and kept as time series. The y bins are fixed, the φ bins span
+    [0, max Φ] at each time.
+    """
+
+    def __init__(self, y_range=(-1.05,1.05), N_bins=256, Nφ_bins=None, cadence=1, scales=3/2, comm=None):
+        self.y_range = y_range
+        self.N_bins = N_bins
+        self.Nφ_bins = Nφ_bins
+        self.cadence = cadence
+        self.scales = scales
+        self.comm = comm
+        self.times = []
+        self.f_Y = []
+        self.E = []
+        self.f_YΦ = []
+        self.φ_edges = []
+
+    def __call__(self, sim_time, Y, dY2):
+        Y.change_scales(self.scales)
+        Φ = dY2.evaluate()
+        Φ.change_scales(self.scales)
+        Y_g, Φ_g = Y['g'], Φ['g']
+
+        # Y is binned once, for both f_Y and f_YΦ
+        H = histograms.Histogram(self.y_range, self.N_bins)
+        i = H.bin(Y_g)
+        H.add_bins(i, Φ_g)
+        if self.comm is not None:
+            H.allreduce(self.comm)
+        self.times.append(sim_time)
+        self.f_Y.append(H.density())
+        self.E.append(H.expectation())
+
+        if self.Nφ_bins is not None:
+            φ_max = histograms.global_range(Φ_g, self.comm)[1]
+            H_Φ = histograms.Histogram((0, φ_max), self.Nφ_bins)
+            f_YΦ = histograms.joint_counts(i, H_Φ.bin(Φ_g), self.N_bins, self.Nφ_bins)
+            if self.comm is not None:
+                histograms.allreduce(f_YΦ, self.comm)
+            self.f_YΦ.append(f_YΦ/(np.sum(f_YΦ)*H.dy*H_Φ.dy))
+            self.φ_edges.append(H_Φ.edges)
+
+    @property
+    def y(self):
+        return histograms.Histogram(self.y_range, self.N_bins).y
+
+    def save(self, filename='in_situ.h5'):
+        """Save the time series to an HDF5 file (from rank 0 only)."""
+        if self.comm is not None and self.comm.rank != 0:
+            return
+        with h5py.File(filename, mode='w') as file:
+            file['times'] = np.array(self.times)
+            file['y'] = self.y
+            file['f_Y'] = np.array(self.f_Y)
+            file['E'] = np.array(self.E)
+            if self.Nφ_bins is not None:
+                file['f_YΦ'] = np.array(self.f_YΦ)
+                file['φ_edges'] = np.array(self.φ_edges)
+
+_contexts = {}
+
+def solver_context(Nx=32,κ=0.1,dealias=3/2):
+    """
+    Domain, ABC velocity field and RK222 solver for the given parameters. These
+    are built once and cached, later calls only resetting the clock and handlers.
+    The cache holds every solver built until clear_contexts() is called.
+    """
+
+    key = (Nx,κ,dealias)
+    if key in _contexts:
+        context = _contexts[key]
+        solver  = context['solver']
+        # Drop the handlers added by earlier runs, rearming those of the solver itself
+        del solver.evaluator.handlers[context['handlers']:]
+        for handler in solver.evaluator.handlers:
+            handler.last_wall_div = handler.last_sim_div = handler.last_iter_div = -1
+        solver.sim_time  = solver.initial_sim_time  = 0
+        solver.iteration = solver.initial_iteration = 0
+        return context
 
     # Domain
     coords = d3.CartesianCoordinates('X_1','X_2','X_3')
     dist   = d3.Distributor(coords, dtype=np.float64)
-    X1_basis = d3.RealFourier(coords['X_1'], size=Nx, bounds=(-np.pi, np.pi), dealias=3/2)
-    X2_basis = d3.RealFourier(coords['X_2'], size=Nx, bounds=(-np.pi, np.pi), dealias=3/2)
-    X3_basis = d3.RealFourier(coords['X_3'], size=Nx, bounds=(-np.pi, np.pi), dealias=3/2)
+    X1_basis = d3.RealFourier(coords['X_1'], size=Nx, bounds=(-np.pi, np.pi), dealias=dealias)
+    X2_basis = d3.RealFourier(coords['X_2'], size=Nx, bounds=(-np.pi, np.pi), dealias=dealias)
+    X3_basis = d3.RealFourier(coords['X_3'], size=Nx, bounds=(-np.pi, np.pi), dealias=dealias)
 
     # Fields
     Y = dist.Field(name='Y', bases=(X1_basis,X2_basis,X3_basis))
@@ -37,30 +160,98 @@ def solve(stop_sim_time,Nx=32):
     U['g'][1] = np.sin(X_1) + np.cos(X_3);
     U['g'][2] = np.sin(X_2) + np.cos(X_1);
 
-    # Initial condition
-    Y['g']    = np.tanh(10*(X_1 + X_2 + X_3))
-
     # Problem
     grad_Y  = d3.grad(Y)
+    dY2     = grad_Y@grad_Y
     problem = d3.IVP([Y], namespace=locals())
     problem.add_equation("dt(Y) - κ*div(grad_Y) = -U@grad(Y)") #
 
     # Solver
     solver = problem.build_solver(d3.RK222)
-    solver.stop_sim_time = stop_sim_time
+
+    context = {'solver':solver,'Y':Y,'U':U,'dY2':dY2,'X':(X_1,X_2,X_3),
+               'handlers':len(solver.evaluator.handlers)}
+    _contexts[key] = context
+    return context
+
+def clear_contexts():
+    """Release the solvers cached by solver_context, e.g. between the resolutions of a sweep."""
+    _contexts.clear()
+
+def solve(stop_sim_time,Nx=32,stencil=5,snapshot_dt=None,adaptive=False,safety=0.5,in_situ=None,snapshots=True,κ=0.1,sharpness=10,timestep=5e-03,dealias=3/2):
+    """
+    Integrate the flow saving the stencil of snapshots centred on stop_sim_time,
+    spaced by snapshot_dt (default the timestep), to 'snapshots'. If stop_sim_time
+    is a list of times the flow is integrated once until the last of them, and
+    the stencil at each is saved to snapshot_label(t). If adaptive the timestep
+    is set by the CFL condition on U, and shortened to land on the stencil times.
+    An InSituPDF passed as in_situ is updated from the fields as the flow evolves,
+    in which case the 3D snapshots may be switched off with snapshots=False.
+    The snapshots are written on the dealiased grid, scales=dealias. The solver
+    is reused across calls with the same Nx, κ and dealias (see solver_context).
+    """
+    
+    # Parameters
+    # κ Equivalent to Peclet number
+    if snapshot_dt is None:
+        snapshot_dt = timestep
+
+    context = solver_context(Nx,κ,dealias)
+    solver  = context['solver']
+    Y, U, dY2 = context['Y'], context['U'], context['dY2']
+    X_1,X_2,X_3 = context['X']
+
+    # Initial condition
+    Y.change_scales(1)
+    Y['g']    = np.tanh(sharpness*(X_1 + X_2 + X_3))
+
+    # Capture the stencil of snapshots around each output time
+    if np.isscalar(stop_sim_time):
+        windows = {snapshot_label():stop_sim_time}
+    else:
+        windows = {snapshot_label(t):t for t in stop_sim_time}
+
+    schedules = []
+    for label,t in (windows.items() if snapshots else []):
+        schedule = StencilSchedule(t,snapshot_dt,n=stencil)
+        handler  = solver.evaluator.add_file_handler(label, custom_schedule=schedule)
+        handler.add_task(Y,   layout='g',name='Y'  ,scales=dealias)
+        handler.add_task(dY2, layout='g',name='dY2',scales=dealias)
+        schedules.append(schedule)
+
+    # Snapshots are evaluated at the start of a step, so take a step from the last
+    if snapshots:
+        solver.stop_sim_time = max(schedule.end_time for schedule in schedules) + timestep/2
+    else:
+        solver.stop_sim_time = np.max(stop_sim_time)
+
+    # CFL, the velocity being steady it need only be evaluated occasionally
+    if adaptive:
+        CFL = d3.CFL(solver, initial_dt=timestep, cadence=10, safety=safety, threshold=0.05)
+        CFL.add_velocity(U)
+        stencil_times = np.sort(np.concatenate([schedule.times for schedule in schedules] + [[]]))
 
     # Main loop
     try:
         logger.info('Starting main loop')
         while solver.proceed:
+
+            if in_situ is not None and solver.iteration % in_situ.cadence == 0:
+                in_situ(solver.sim_time, Y, dY2)
             
-            solver.step(timestep)
+            if adaptive:
+                dt = CFL.compute_timestep()
+                # Do not step over the next stencil time
+                t_next = stencil_times[stencil_times > solver.sim_time*(1 + 1e-12)]
+                if len(t_next) > 0:
+                    dt = min(dt, t_next[0] - solver.sim_time)
+                solver.step(dt)
+            else:
+                solver.step(timestep)
 
-            # Capture the last 5 snapshots
-            if  solver.iteration == int(stop_sim_time/timestep) - 5:
-                snapshots = solver.evaluator.add_file_handler('snapshots', iter=1)
-                snapshots.add_task(Y,      layout='g',name='Y'     ,scales=3/2)
-                snapshots.add_task(grad_Y, layout='g',name='grad_Y',scales=3/2)
+        # The loop ends before recording the final state
+        if in_situ is not None:
+            in_situ(solver.sim_time, Y, dY2)
     except:
         logger.error('Exception raised, triggering end of main loop.')
         raise
@@ -69,39 +260,100 @@ def solve(stop_sim_time,Nx=32):
 
     return None;
 
-def Data(N_bins=256):
-    
-    # Data loading
-    file   = h5py.File('./snapshots/snapshots_s1.h5', mode='r')
-    times  = file['tasks/Y'].dims[0][0][:]
-    X1_data = file['tasks/Y'].dims[1][0][:]
-    X2_data = file['tasks/Y'].dims[2][0][:]
-    X3_data = file['tasks/Y'].dims[3][0][:]
+def world_comm():
+    """MPI.COMM_WORLD when run with more than one process, else None (also without mpi4py)."""
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        return None
+    return MPI.COMM_WORLD if MPI.COMM_WORLD.size > 1 else None
 
-    Y_data   = file['tasks/Y'][:,...]
-    dY2_data = np.sum(file['tasks/grad_Y'][...]**2,axis=1)
+def local_slab(N,comm=None):
+    """Slice of the N points along X_1 handled by this rank of comm."""
+    if comm is None:
+        return slice(None)
+    n = np.linspace(0,N,comm.size+1).astype(int)
+    return slice(n[comm.rank],n[comm.rank+1])
 
-    # PDF f_Y
-    f_np2,y = np.histogram(Y_data[-1,...].flatten(),bins=N_bins,density=True); # n + 2 (-1)
-    f_np1,y = np.histogram(Y_data[-2,...].flatten(),bins=N_bins,density=True); # n + 1 (-2)
+class SnapshotReader:
+    """
+    Lazy reader of a Dedalus snapshot file. Single snapshots of a task are read
+    as h5py hyperslabs of at most chunk X_1 planes, restricted to the slab of X_1
+    belonging to this rank of comm, and fed to streaming histograms.
+    """
 
-    f_nm1,y = np.histogram(Y_data[-4,...].flatten(),bins=N_bins,density=True); # n - 1 (-4)
-    f_nm2,y = np.histogram(Y_data[-5,...].flatten(),bins=N_bins,density=True); # n - 2 (-5)
+    def __init__(self, filename, chunk=8, comm=None):
+        self.file = h5py.File(filename, mode='r')
+        self.chunk = chunk
+        self.comm = comm
+        self.times = self.file['tasks/Y'].dims[0][0][:]
+        self.X = [self.file['tasks/Y'].dims[k][0][:] for k in (1,2,3)]
+        self.slab = local_slab(len(self.X[0]),comm)
 
-    y       = 0.5*(y[1:] + y[:-1]); dy = y[1] - y[0];
+    def chunks(self, task, n):
+        """Yield the chunks of snapshot(s) n, an index or slice, of task ('Y' or 'dY2')."""
+        start, stop, _ = self.slab.indices(len(self.X[0]))
+        for i in range(start, stop, self.chunk):
+            s = slice(i, min(i + self.chunk, stop))
+            if task == 'dY2' and 'tasks/dY2' not in self.file:
+                # Files written before dY2 was a task
+                yield np.sum(self.file['tasks/grad_Y'][n,:,s,...]**2,axis=-4)
+            else:
+                yield self.file['tasks/' + task][n,s,...]
 
-    # Time derivate df_s/dt
-    dt   = times[-1] - times[-2];
-    dfdt = (-1./12.)*f_np2 + (2./3.)*f_np1 - (2./3.)*f_nm1 + (1./12.)*f_nm2;
+    def stencil_histograms(self, n, m, N_bins, y_range, Φ='dY2'):
+        """
+        Stacked counts of Y for the snapshots n (a slice), and the Histogram of Y with
+        conditional sums of task Φ for the m-th of them, in a single pass over the
+        chunks in which each sample of Y is read and binned once.
+        """
+        k = np.arange(len(self.times))[n]
+        counts = np.zeros((len(k), N_bins))
+        H = histograms.Histogram(y_range, N_bins)
+        for Y_c, Φ_c in zip(self.chunks('Y', n), self.chunks(Φ, k[m])):
+            i = H.bin(Y_c).reshape(len(k), -1)
+            H.add_bins(i[m], Φ_c)
+            counts += histograms.stacked_bincount(i, N_bins)
+        if self.comm is not None:
+            histograms.allreduce(counts, self.comm)
+            H.allreduce(self.comm)
+        return counts, H
+
+def Data(N_bins=256,stop_sim_time=None,comm=None,chunk=8,y_range=(-1.05,1.05)):
+    """
+    Estimate f_Y and E{|∇Y|^2|Y} from the snapshots, which are read lazily chunk
+    X_1 planes at a time. If an MPI communicator comm is given each rank reads
+    and bins only its own slab of X_1 and the histograms are summed over ranks.
+    The bins span the fixed y_range, as |Y| <= 1 by the maximum principle, so
+    the snapshots are read in a single pass. Y_data is the X_3=0 plane of the
+    last snapshot, as used by Plot.
+    """
+    
+    # Data loading, once every rank has finished writing
+    if comm is not None:
+        comm.Barrier()
+    label  = snapshot_label(stop_sim_time)
+    reader = SnapshotReader('./%s/%s_s1.h5'%(label,label),chunk=chunk,comm=comm)
+    times  = reader.times
+    X1_data,X2_data,X3_data = reader.X
+    Y_data = reader.file['tasks/Y'][-1:,...,0:1]
+
+    # PDF f_Y of the stencil n-2,...,n+2 (-5,...,-1) and E{Φ|Y} at n (-3), on shared bins
+    stencil  = slice(-5,None)
+    counts,H = reader.stencil_histograms(stencil,2,N_bins,y_range,Φ='dY2')
+    f_nm2,f_nm1,f_n,f_np1,f_np2 = histograms.stacked_density(None,y_range,N_bins,counts=counts)
+
+    # Time derivate df_s/dt, the stencil assumes uniformly spaced snapshots
+    dt   = check_uniform(times[-5:]);
+    w    = finite_difference.central_weights(order=4) # n-2,...,n+2
+    dfdt = w[0]*f_nm2 + w[1]*f_nm1 + w[3]*f_np1 + w[4]*f_np2;
     dfdt /=dt;
 
     # Expectation
-    f_YΦ,y,φ = np.histogram2d(Y_data[-3,...].flatten(), dY2_data[-3,...].flatten(),bins=N_bins,density=True) # n (-3)
-    φ = .5*(φ[1:]+φ[:-1]); dφ = φ[1] - φ[0];
-    y = 0.5*(y[1:] + y[:-1]); dy = y[1] - y[0];
+    y = H.y; dy = H.dy;
 
-    f_Y =  np.sum(  f_YΦ,axis=1)*dφ     # f_Y(y)
-    E   = (np.sum(φ*f_YΦ,axis=1)*dφ)/f_Y; # E{Φ|Y} = int_φ f_Φ|Y(φ|y)*φ dφ
+    f_Y = H.density()     # f_Y(y)
+    E   = H.expectation() # E{Φ|Y} = int_φ f_Φ|Y(φ|y)*φ dφ
     
     return X1_data,X2_data,Y_data,y,f_Y,E
 
@@ -148,7 +400,12 @@ def Plot(x_data,y_data,Y_data,y,f,E,stop_sim_time):
 
 if __name__ == "__main__":
     
-    for t in [0.5,1.0,2.0,4.0]:
-        solve(stop_sim_time=t,Nx=48)
-        x_data,y_data,Y_data,y,f,E = Data(N_bins=128)
-        Plot(x_data,y_data,Y_data,y,f,E,stop_sim_time=t)
+    # Run in serial, or in parallel with mpiexec -n <procs> python3 abc_flow_paper_figures.py
+    comm = world_comm()
+
+    times = [0.5,1.0,2.0,4.0]
+    solve(stop_sim_time=times,Nx=48)
+    for t in times:
+        x_data,y_data,Y_data,y,f,E = Data(N_bins=128,stop_sim_time=t,comm=comm)
+        if comm is None or comm.rank == 0:
+            Plot(x_data,y_data,Y_data,y,f,E,stop_sim_time=t)
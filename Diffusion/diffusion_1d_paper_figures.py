@@ -11,9 +11,19 @@ This notebook applies the forward Kolmogorov equation derived in *Craske J. et a
 
 import numpy as np
 import scipy.stats as ss
+import scipy.signal as sg
+import scipy.linalg as sl
 import dedalus.public as d3
 import logging
 import h5py
+import os
+import shutil
+import multiprocessing
+import functools
+import contextlib
+import histograms
+import finite_difference
+import regrid
 logger = logging.getLogger(__name__)
 
 root = logging.root
@@ -40,7 +50,33 @@ def OU(Y_t,W_t,dt, μ_z,a,σ):
   # Euler Maruyama
   return  Y_t + a*(μ_z - Y_t)*dt + σ * dW_t
 
-def Solve(N=2000,T=10,Nz=24,a=5,σ=1,W=None):
+def OU_Boundaries(W,dt, μ_z,a,σ):
+
+  """
+  Boundary data g_n = OU(Y_n,W_n) for all time steps, walls and paths at once,
+  where W has shape (N,2,...) and Y_n is the boundary value of Y(z) at step n.
+
+  With CNAB1 the boundary equation Y(z=0) = g0 is treated as Crank-Nicolson,
+  so that Y_{n+1} = 2*g_n - Y_n. Combined with the OU update this gives the
+  linear recursion Y_{n+1} = (1-2*a*dt)*Y_n + 2*(a*μ_z*dt + σ*dW_n), Y_0 = 0,
+  which is evaluated along the time axis as a first order filter.
+  """
+
+  W   = np.asarray(W)
+  F_n = 2*(a*μ_z*dt + σ*np.sqrt(dt)*W)
+  Y_n = sg.lfilter([1.],[1.,-(1.-2*a*dt)],F_n,axis=0) # Y_{n+1}
+  Y_n = np.concatenate((np.zeros_like(Y_n[:1]),Y_n[:-1]),axis=0)
+
+  return OU(Y_t=Y_n,W_t=W,dt=dt,μ_z=μ_z,a=a,σ=σ)
+
+def Solve(N=2000,T=10,Nz=24,a=5,σ=1,W=None,G=None,base_path='snapshots',in_memory=False):
+
+  """
+  Solve the 1D diffusion equation with OU boundary conditions, given either
+  the noise W (N,2) or the boundary data G = OU_Boundaries(W,...). Snapshots of
+  Y and Yz (scales=2) are written to base_path, or if in_memory is True
+  returned as arrays (times,z_cheb,Y_cheb,Yz_cheb) without any file I/O.
+  """
 
   zcoord = d3.Coordinate('z')
   dist   = d3.Distributor(zcoord, dtype=np.float64)
@@ -76,12 +112,21 @@ def Solve(N=2000,T=10,Nz=24,a=5,σ=1,W=None):
 
   np.random.seed(42)
   T_vec,dt = np.linspace(0,T,N,retstep=True)
-  if W is None:
-    W = ss.norm.rvs(loc=0, scale=1, size=(N,2))
-
-  snapshots = solver.evaluator.add_file_handler('snapshots',iter=1)
-  snapshots.add_task(Y , layout='g',name='Y'  ,scales=2)
-  snapshots.add_task(Yz, layout='g',name='Yz' ,scales=2)
+  if G is None:
+    if W is None:
+      W = ss.norm.rvs(loc=0, scale=1, size=(N,2))
+    G = OU_Boundaries(W,dt=dt,μ_z=0,a=a,σ=σ)
+
+  if in_memory:
+    # Preallocate, allowing one extra step for round-off in sim_time
+    z_cheb  = dist.local_grid(zbasis,scale=2)
+    times   = np.zeros(N+1)
+    Y_cheb  = np.zeros((N+1,len(z_cheb)))
+    Yz_cheb = np.zeros((N+1,len(z_cheb)))
+  else:
+    snapshots = solver.evaluator.add_file_handler(base_path,iter=1)
+    snapshots.add_task(Y , layout='g',name='Y'  ,scales=2)
+    snapshots.add_task(Yz, layout='g',name='Yz' ,scales=2)
 
   # Main loop
   logger.info('Starting main loop')
@@ -90,21 +135,179 @@ def Solve(N=2000,T=10,Nz=24,a=5,σ=1,W=None):
     n    = solver.iteration
 
     # Specify the bcs according to OU process
-    Yt_z0    = Y(z=0).evaluate()['g'][0];
-    g0['g'] = OU(Y_t = Yt_z0, W_t=W[n,0],dt=dt,μ_z=0,a=a,σ=σ)
-
-    Yt_z1    = Y(z=1).evaluate()['g'][0]
-    g1['g'] = OU(Y_t = Yt_z1, W_t=W[n,1],dt=dt,μ_z=0,a=a,σ=σ)
+    g0['g'] = G[n,0]
+    g1['g'] = G[n,1]
+
+    # Capture the state the file handler would record at this iteration
+    if in_memory:
+      Yz_n = Yz.evaluate()
+      Y.change_scales(2)
+      Yz_n.change_scales(2)
+      times[n]     = solver.sim_time
+      Y_cheb[n,:]  = Y['g']
+      Yz_cheb[n,:] = Yz_n['g']
 
     solver.step(dt)
 
+  if in_memory:
+    n = solver.iteration
+    return times[:n], z_cheb, Y_cheb[:n,:], Yz_cheb[:n,:]
+
   return None
 
 
+def Chebyshev_Grid(Nz,scale=1):
+
+  """
+  Dedalus ChebyshevT grid on (0,1), i.e. Gauss-Chebyshev points
+  """
+
+  M = int(np.ceil(scale*Nz))
+  return 0.5*(1 - np.cos(np.pi*(np.arange(M) + 0.5)/M))
+
+@functools.lru_cache(maxsize=None)
+def Grid(N,T,Nz=24):
+
+  """
+  Snapshot times and the (Chebyshev, uniform) z grids used by Data, found
+  without running a simulation. Times follow the solver's accumulation of
+  sim_time += dt until T is reached, as snapshots are taken before each step.
+  The arrays are cached and so returned read-only.
+  """
+
+  T_vec,dt = np.linspace(0,T,N,retstep=True)
+  times = []
+  t     = 0.
+  while t < T:
+    times.append(t)
+    t += dt
+
+  times   = np.array(times)
+  z_cheb  = Chebyshev_Grid(Nz,scale=2)
+  z_data  = np.arange(0,1,z_cheb[1]-z_cheb[0])
+  for X in [times,z_cheb,z_data]:
+    X.setflags(write=False)
+
+  return times, z_cheb, z_data
+
+def Chebyshev_Tau(Nz):
+
+  """
+  The first order tau formulation of Solve in Chebyshev T coefficients on (0,1):
+  the derivative D and the lift polynomial U = U_{Nz-1}, the last mode of the
+  ChebyshevU basis zbasis.derivative_basis(1), such that
+  Yz = D Y + τ1 U and Yzz = D Yz + τ2 U.
+  """
+
+  D = np.zeros((Nz,Nz))
+  for k in range(1,Nz):
+    D[:k,k] = 2*np.polynomial.chebyshev.chebder(np.eye(k+1)[k]) # d/dz = 2 d/dx
+
+  # U_n = 2 (T_n + T_{n-2} + ...), halving T_0
+  U = np.zeros(Nz)
+  U[Nz-1::-2] = 2
+  if (Nz-1)%2 == 0:
+    U[0] = 1
+
+  return D, U
+
+def Solve_Batch(N=2000,T=10,Nz=24,a=5,σ=1,W=None,G=None):
+
+  """
+  Solve the 1D diffusion equation for many paths at once as a single
+  (Nz+2 x Paths) state, given either W (N,2,Paths) or G = OU_Boundaries(W,...).
+
+  The state holds the Chebyshev T coefficients of Y and the tau variables τ1,τ2
+  of Solve, which is discretised identically: CNAB1 gives
+  (M/dt + L/2) X_{n+1} = (M/dt - L/2) X_n + F_n, the boundary rows having M = 0
+  so that Y_{n+1}(0) + Y_n(0) = 2*g0. This is factorised once, after which each
+  step is a matrix product. Returns (times,z_cheb,Y_cheb,Yz_cheb) on the Solve
+  scales=2 grid, Yz including the τ1 term as in Solve, with paths along the last axis.
+  """
+
+  np.random.seed(42)
+  T_vec,dt = np.linspace(0,T,N,retstep=True)
+  if G is None:
+    if W is None:
+      W = ss.norm.rvs(loc=0, scale=1, size=(N,2,1))
+    G = OU_Boundaries(W,dt=dt,μ_z=0,a=a,σ=σ)
+
+  # Rows: the Nz T coefficients of dt(Y) - Yzz, then Y(z=0), Y(z=1)
+  D,U = Chebyshev_Tau(Nz)
+  M = np.zeros((Nz+2,Nz+2))
+  L = np.zeros((Nz+2,Nz+2))
+  M[:Nz,:Nz] = np.eye(Nz)
+  L[:Nz,:Nz] = -D@D
+  L[:Nz, Nz] = -D@U
+  L[:Nz,-1 ] = -U
+  L[ Nz,:Nz] = (-1.)**np.arange(Nz)
+  L[-1 ,:Nz] = 1.
+
+  lu = sl.lu_factor(M/dt + L/2)
+  A  = sl.lu_solve(lu,M/dt - L/2)     # X_{n+1} = A X_n + B g_n
+  B  = sl.lu_solve(lu,np.eye(Nz+2)[:,Nz:])
+
+  times,z_cheb,_ = Grid(N,T,Nz)
+
+  X_n = np.zeros((len(times),Nz+2,G.shape[-1]))
+  for n in range(len(times)-1):
+    X_n[n+1] = A@X_n[n] + B@G[n]
+
+  # Evaluate on the scales=2 grid
+  P       = np.polynomial.chebyshev.chebvander(2*z_cheb-1,Nz-1)
+  Pz      = np.hstack((P@D,P@U[:,None]))
+  Y_cheb  = np.einsum('ij,njp->nip',P,X_n[:,:Nz])
+  Yz_cheb = np.einsum('ij,njp->nip',Pz,X_n[:,:Nz+1])
+
+  return times, z_cheb, Y_cheb, Yz_cheb
+
+def Check_Batch(N=2000,T=10,Nz=24,Paths=4):
+
+  """
+  Maximum difference in Y and Yz between Solve_Batch and Solve(in_memory=True)
+  given the same boundary data, which should be at round-off.
+  """
+
+  W = ss.norm.rvs(loc=0, scale=1, size=(N,2,Paths))
+  G = OU_Boundaries(W,dt=T/(N-1),μ_z=0,a=5,σ=1)
+  _,_,Y_cheb,Yz_cheb = Solve_Batch(N,T,Nz,G=G)
+
+  err = 0
+  for n in range(Paths):
+    _,_,Y_n,Yz_n = Solve(N,T,Nz,G=G[:,:,n],in_memory=True)
+    err = max(err,np.max(abs(Y_n - Y_cheb[...,n])),np.max(abs(Yz_n - Yz_cheb[...,n])))
+
+  return err
+
+def Chunks(X):
+
+  """
+  Iterate over the paths (last axis) of an ensemble array
+  """
+
+  X = np.asarray(X)
+  if X.ndim < 2:
+    yield X
+  else:
+    for n in range(X.shape[-1]):
+      yield X[...,n]
+
 def density(Y_data,Range,N_bins):
 
-  f,y = np.histogram(Y_data[...].flatten(),range=Range,bins=N_bins,density=True); 
-  y   = 0.5*(y[1:] + y[:-1]);
+  H = histograms.Histogram(Range,N_bins)
+  for Y_n in Chunks(Y_data):
+    H.add(Y_n)
+
+  return H.density(),H.y
+
+def density_series(Y_data,Range,N_bins):
+
+  """
+  f_Y(y,t) of the ensemble Y_data (time,z,Paths) at every time, shape (time,N_bins)
+  """
+
+  f = histograms.stacked_density(Y_data,Range,N_bins)
+  y = histograms.Histogram(Range,N_bins).y
 
   return f,y
 
@@ -112,63 +315,125 @@ def diffusion(dY2_data,Y_data,Range,N_bins):
 
   # Expectation
   # Let Φ = |∇Y|^2 and φ its dummy variable
+  # E{Φ|Y} = int_φ f_Φ|Y(φ|y)*φ dφ, accumulated one path at a time
 
-  Y   = Y_data[...].flatten()
-  dY2 = dY2_data[...].flatten()
-
-  f_YΦ,y,φ = np.histogram2d(Y,dY2,range = (Range,(min(dY2),max(dY2))),bins=N_bins,density=True)
-  φ = .5*(φ[1:]+φ[:-1]); dφ = φ[1] - φ[0];
-  #y = .5*(y[1:]+y[:-1]); dy = y[1] - y[0];
-  f_Y =  np.sum(  f_YΦ,axis=1)*dφ;      # f_Y(y)
-  E   = (np.sum(φ*f_YΦ,axis=1)*dφ)/f_Y; # E{Φ|Y} = int_φ f_Φ|Y(φ|y)*φ dφ
+  H = histograms.Histogram(Range,N_bins)
+  for Y_n,dY2_n in zip(Chunks(Y_data),Chunks(dY2_data)):
+    H.add(Y_n,dY2_n)
 
-  return -E
+  return -H.expectation()
 
 def Expectation(Y,dY,y,N_bins):
 
-    f_YΦ,_,φ = np.histogram2d(Y,dY,range = ((min(y),max(y)),(min(dY),max(dY))),bins=N_bins,density=True) # n (-3)
-    φ   = .5*(φ[1:]+φ[:-1]);
-    dφ  = φ[1] - φ[0];
-    E   = np.sum(φ*f_YΦ,axis=1)*dφ # E{Φ|Y=y}*f(y) = int_φ f_ΦY(φ,y)*φ dφ where φ = ∇Y_t
+    # E{Φ|Y=y}*f(y) = int_φ f_ΦY(φ,y)*φ dφ where φ = ∇Y_t
+    H = histograms.Histogram((np.min(y),np.max(y)),N_bins)
+    for Y_n,dY_n in zip(Chunks(Y),Chunks(dY)):
+      H.add(Y_n,dY_n)
 
-    return E
+    return H.weighted_density()
 
 def drift(f,y, Y0,Y1,Yz0,Yz1,N_bins):
 
   nz_minus = -1 # at z=0
   nz_plus  =  1 # at z=1
-  
-  Y_t   = np.hstack( ( Y1[...].flatten(),   Y0[...].flatten())  )
-  nDY_t = np.hstack( (nz_plus*Yz1[...].flatten(), nz_minus*Yz0[...].flatten())  )
-  return 2*Expectation(Y_t,nDY_t,y,N_bins)/f
 
-def Data():
+  # E{n.∇Y|Y=y}*f(y) over both boundaries
+  H = histograms.Histogram((np.min(y),np.max(y)),N_bins)
+  for Y_n,Yz_n in zip(Chunks(Y1),Chunks(Yz1)):
+    H.add(Y_n,nz_plus*Yz_n)
+  for Y_n,Yz_n in zip(Chunks(Y0),Chunks(Yz0)):
+    H.add(Y_n,nz_minus*Yz_n)
 
-  # Data loading
-  file   = h5py.File('snapshots/snapshots_s1.h5', mode='r')
+  return 2*H.weighted_density()/f
 
-  # Interpolate the data (t,z) from a Chebyshev grid onto a uniform grid
-  Y_cheb  = file['tasks/Y' ][:,:]
-  Yz_cheb = file['tasks/Yz'][:,:]
-  z_cheb  = file['tasks/Y'].dims[1][0][:]
-  times   = file['tasks/Y'].dims[0][0][:]
+def Terms(Y_data,dY2_data, Y0_Data,Y1_Data,Y0zData,Y1zData,Range,N_bins):
+
+  """
+  Estimate f_Y, D1 and D2 on shared bins in a single pass over the paths,
+  the bin index of each sample being computed once for both counts and Φ sums
+  """
+
+  nz_minus = -1 # at z=0
+  nz_plus  =  1 # at z=1
+
+  H  = histograms.Histogram(Range,N_bins) # Φ = |∇Y|^2 in the interior
+  Hb = histograms.Histogram(Range,N_bins) # Φ = n.∇Y on the boundaries
+  for Y_n,dY2_n,Y0_n,Y1_n,Y0z_n,Y1z_n in zip(*map(Chunks,(Y_data,dY2_data,Y0_Data,Y1_Data,Y0zData,Y1zData))):
+    H.add(Y_n,dY2_n)
+    Hb.add(Y1_n,nz_plus *Y1z_n)
+    Hb.add(Y0_n,nz_minus*Y0z_n)
+
+  f  = H.density()
+  D1 = 2*Hb.weighted_density()/f
+  D2 =  -H.expectation()
 
+  return f,H.y,D1,D2
+
+def Data(base_path='snapshots',snapshots=None,method='linear'):
+
+  """
+  Load the snapshots written by Solve, or take those returned by
+  Solve(in_memory=True), and interpolate them onto a uniform grid
+  either linearly or by evaluating the Chebyshev interpolant
+  """
+
+  if snapshots is None:
+    # Data loading
+    name   = os.path.basename(os.path.normpath(base_path))
+    file   = h5py.File(os.path.join(base_path,name + '_s1.h5'), mode='r')
+
+    Y_cheb  = file['tasks/Y' ][:,:]
+    Yz_cheb = file['tasks/Yz'][:,:]
+    z_cheb  = file['tasks/Y'].dims[1][0][:]
+    times   = file['tasks/Y'].dims[0][0][:]
+  else:
+    times,z_cheb,Y_cheb,Yz_cheb = snapshots
+
+  # Interpolate the data (t,z) from a Chebyshev grid onto a uniform grid
   dz_cheb = z_cheb[1]-z_cheb[0];
   z_data  = np.arange(0,1,dz_cheb);
-  s       = (len(times),len(z_data));
-  Y_data  = np.zeros(s)
-  Yz_data = np.zeros(s)
-  for i,t in enumerate(times):
-    Y_data[i,:] = np.interp(z_data, z_cheb, Y_cheb[i,:] )
-    Yz_data[i,:]= np.interp(z_data, z_cheb, Yz_cheb[i,:])
+  Y_data  = regrid.regrid(Y_cheb ,z_cheb,z_data,method,axis=1)
+  Yz_data = regrid.regrid(Yz_cheb,z_cheb,z_data,method,axis=1)
 
   return times, z_data,Y_data,Yz_data;
 
 
-def Generate_Ensemble(N=1000,T=5,Paths=250):
-   
-  Solve(N,T)
-  times, z_data,_,_ = Data()
+def Solve_Path(args):
+
+  """
+  Solve and load a single ensemble path, worker for Generate_Ensemble
+  """
+
+  N,T,G_n,base_path,in_memory = args
+  if in_memory:
+    _,_,Y_n,Yz_n = Data(snapshots=Solve(N,T,G=G_n,in_memory=True))
+  else:
+    # the file handler creates only the leaf directory base_path
+    parent = os.path.dirname(os.path.normpath(base_path))
+    if parent:
+      os.makedirs(parent,exist_ok=True)
+    Solve(N,T,G=G_n,base_path=base_path)
+    _,_,Y_n,Yz_n = Data(base_path)
+
+  return Y_n,Yz_n
+
+def Generate_Ensemble(N=1000,T=5,Paths=250,processes=None,base_dir='ensemble',in_memory=False,batched=False,seed=42):
+
+  """
+  Generate an ensemble of paths, serially if processes is None or else
+  using a pool of processes, each path writing to base_dir/path_n/,
+  which is removed once the path has been read. If in_memory is True
+  the snapshots are never written to disk, while
+  if batched is True all paths are integrated together by Solve_Batch
+  (in which case processes must be None). The noise W is drawn from a
+  generator seeded by seed, reproducing the ensemble of the original
+  warm-up Solve(N,T), which seeded the global RNG and then drew W (N,2).
+  """
+
+  if batched and processes is not None:
+    raise ValueError("batched and processes are exclusive, Solve_Batch integrates all paths in this process")
+
+  times,_,z_data = Grid(N,T)
 
   pad = 20
   stp = (len(times)-pad,Paths)
@@ -181,26 +446,44 @@ def Generate_Ensemble(N=1000,T=5,Paths=250):
   Y_data   = np.zeros(stzp)
   dY2_data = np.zeros(stzp)
 
-  W  = ss.norm.rvs(loc=0, scale=1, size=(N,2,Paths))
+  rng = np.random.RandomState(seed)
+  rng.standard_normal((N,2)) # the draws of the warm-up solve
+  W  = ss.norm.rvs(loc=0, scale=1, size=(N,2,Paths), random_state=rng)
+  G  = OU_Boundaries(W,dt=T/(N-1),μ_z=0,a=5,σ=1)
 
-  for n in range(Paths):
+  # spawn rather than fork so that each worker initialises its own MPI/FFTW state
+  pool = contextlib.nullcontext() if processes is None else multiprocessing.get_context('spawn').Pool(processes)
+
+  with pool:
+
+    if batched:
+      times,z_cheb,Y_cheb,Yz_cheb = Solve_Batch(N,T,G=G)
+      results = (Data(snapshots=(times,z_cheb,Y_cheb[...,n],Yz_cheb[...,n]))[2:] for n in range(Paths))
+    elif processes is None:
+      tasks   = ((N,T,G[:,:,n],'snapshots',in_memory) for n in range(Paths))
+      results = map(Solve_Path,tasks)
+    else:
+      tasks   = [(N,T,G[:,:,n],os.path.join(base_dir,'path_%d'%n),in_memory) for n in range(Paths)]
+      results = pool.imap(Solve_Path,tasks,chunksize=max(1,Paths//(4*processes)))
 
-    Solve(N,T,W=W[:,:,n])
+    for n,(Y_n,Yz_n) in enumerate(results):
 
-    _,_,Y_n,Yz_n  = Data()
+      # Each path's snapshots are no longer needed once read
+      if processes is not None and not in_memory:
+        shutil.rmtree(os.path.join(base_dir,'path_%d'%n),ignore_errors=True)
 
-    # z-integrated
-    Y_data[:,:,n]  =   Y_n[pad:,:] # time,z_data
-    dY2_data[:,:,n]=  Yz_n[pad:,:]**2
+      # z-integrated
+      Y_data[:,:,n]  =   Y_n[pad:,:] # time,z_data
+      dY2_data[:,:,n]=  Yz_n[pad:,:]**2
 
-    # Boundaries
-    Y0_Data[:,n] = Y_n[pad:, 0] # time,z=0
-    Y1_Data[:,n] = Y_n[pad:,-1]
-    Y0zData[:,n] = Yz_n[pad:, 0]
-    Y1zData[:,n] = Yz_n[pad:,-1]
+      # Boundaries
+      Y0_Data[:,n] = Y_n[pad:, 0] # time,z=0
+      Y1_Data[:,n] = Y_n[pad:,-1]
+      Y0zData[:,n] = Yz_n[pad:, 0]
+      Y1zData[:,n] = Yz_n[pad:,-1]
 
-    if n%(Paths//5) == 0:
-      print('Path = %d'%n,'\n')
+      if n%(Paths//5) == 0:
+        print('Path = %d'%n,'\n')
 
   return {'Y_data':Y_data,'dY2_data':dY2_data, 
           'Y0_Data':Y0_Data,'Y1_Data':Y1_Data,
@@ -263,19 +546,7 @@ def Plot_Terms(Y_data,dY2_data, Y0_Data,Y1_Data,Y0zData,Y1zData,N_bins=512):
   #Range = (   min(Y_data[...].flatten()),max(Y_data[...].flatten())  );
   Range = (-1.25,1.25)
   # Estimate the terms
-  f,y = density(Y_data,Range,N_bins)
-  D1  = drift(f,y, Y0_Data,Y1_Data,Y0zData,Y1zData, N_bins)
-  D2  = diffusion(dY2_data,Y_data,Range,N_bins)
-
-  # Derivative
-  N = len(y)
-  D = np.zeros((N,N))
-  for i in range(N):
-    if i < N - 1:
-      D[i,i+1] = 1
-    if i > 0:
-      D[i,i-1] =-1
-  D*=.5/(y[1]-y[0])
+  f,y,D1,D2 = Terms(Y_data,dY2_data, Y0_Data,Y1_Data,Y0zData,Y1zData,Range,N_bins)
 
   fig, axs = plt.subplots(2, 2, layout='constrained',figsize=(12,6),sharex=True)
 
@@ -284,7 +555,7 @@ def Plot_Terms(Y_data,dY2_data, Y0_Data,Y1_Data,Y0zData,Y1zData,N_bins=512):
 
   from scipy.ndimage import gaussian_filter1d
   LHS = gaussian_filter1d(D1*f,sigma=2)
-  RHS = D@(gaussian_filter1d(D2*f,sigma=2))
+  RHS = finite_difference.derivative(gaussian_filter1d(D2*f,sigma=2),y[1]-y[0])
   
   axs[1,0].plot(y[1:-1],LHS[1:-1],'r:', linewidth=2,label=r'$\mathbb{D}^{(1)} f_Y$')
   axs[1,0].plot(y[1:-1],RHS[1:-1],'b--', linewidth=2,label=r'$\partial_y \left( \mathbb{D}^{(2)} f_Y \right)$')
@@ -0,0 +1,79 @@
+import numpy as np
+import scipy.sparse as sp
+
+""" Finite difference first derivatives on uniform grids, e.g. of binned densities in y
+or of snapshots in time. Central stencils of even order are available either as
+sparse (banded) matrices or applied directly with array slices, which avoids building
+a dense N x N matrix. At the ends of the grid the stencil is either truncated, points
+outside the grid being taken as zero, or replaced by a one-sided stencil of the same order.
+"""
+
+# Central first derivative weights for offsets -p,...,p
+_central = {
+    2: np.array([-1/2, 0, 1/2]),
+    4: np.array([1/12, -2/3, 0, 2/3, -1/12]),
+    6: np.array([-1/60, 3/20, -3/4, 0, 3/4, -3/20, 1/60]),
+}
+
+# One-sided first derivative weights for rows 0,...,p-1 at the left end
+_one_sided = {
+    2: [np.array([-3/2, 2, -1/2])],
+    4: [np.array([-25/12, 4, -3, 4/3, -1/4]),
+        np.array([-1/4, -5/6, 3/2, -1/2, 1/12])],
+    6: [np.array([-49/20, 6, -15/2, 20/3, -15/4, 6/5, -1/6]),
+        np.array([-1/6, -77/60, 5/2, -5/3, 5/6, -1/4, 1/30]),
+        np.array([1/30, -2/5, -7/12, 4/3, -1/2, 2/15, -1/60])],
+}
+
+def central_weights(order=2):
+    """Weights of the central first derivative stencil for offsets -order/2,...,order/2."""
+    if order not in _central:
+        raise ValueError("order must be one of %s" % sorted(_central))
+    return _central[order].copy()
+
+def derivative_matrix(N, dx, order=2, boundary='zero', format='csr'):
+    """
+    Sparse N x N matrix D such that D@f approximates df/dx. The boundary rows either
+    truncate the central stencil ('zero') or use a one-sided stencil ('one-sided').
+    """
+    w = central_weights(order)
+    p = order//2
+    if N < len(w):
+        raise ValueError("N must be at least %d for order %d" % (len(w), order))
+
+    D = sp.diags(w, np.arange(-p, p+1), shape=(N, N), format='lil')
+    if boundary == 'one-sided':
+        for i, row in enumerate(_one_sided[order]):
+            D[i, :] = 0
+            D[i, :len(row)] = row
+            D[N-1-i, :] = 0
+            D[N-1-i, N-len(row):] = -row[::-1]
+    elif boundary != 'zero':
+        raise ValueError("boundary must be 'zero' or 'one-sided'")
+
+    return D.asformat(format)/dx
+
+def derivative(f, dx, order=2, boundary='zero', axis=-1):
+    """Apply the stencil of derivative_matrix to f along axis using slices."""
+    w = central_weights(order)
+    p = order//2
+    f = np.moveaxis(np.asarray(f, dtype=np.float64), axis, -1)
+    N = f.shape[-1]
+    if N < len(w):
+        raise ValueError("N must be at least %d for order %d" % (len(w), order))
+
+    df = np.zeros_like(f)
+    for k, w_k in zip(range(-p, p+1), w):
+        if w_k == 0:
+            continue
+        # df[i] += w_k f[i+k] for 0 <= i+k < N
+        df[..., max(0, -k):N-max(0, k)] += w_k*f[..., max(0, k):N-max(0, -k)]
+
+    if boundary == 'one-sided':
+        for i, row in enumerate(_one_sided[order]):
+            df[..., i] = f[..., :len(row)] @ row
+            df[..., N-1-i] = -(f[..., N-len(row):] @ row[::-1])
+    elif boundary != 'zero':
+        raise ValueError("boundary must be 'zero' or 'one-sided'")
+
+    return np.moveaxis(df/dx, -1, axis)
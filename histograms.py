@@ -0,0 +1,194 @@
+import numpy as np
+import h5py
+
+""" Streaming histogram estimators for the terms of the forward Kolmogorov equation.
+
+Samples of Y, and optionally of a second variable Φ (e.g. |∇Y|^2), are added in
+chunks to an accumulator with fixed bin edges which keeps only the running sums
+
+    counts[i] = #{Y in bin i},  Φ_sum[i] = sum of Φ over {Y in bin i}
+
+from which f_Y(y) and E{Φ|Y=y} follow at any point. Memory is O(N_bins).
+Histograms on the same bins accumulated separately (e.g. by different
+processes or ensemble shards) are combined with + and saved/loaded as .npz
+or .h5 files without the raw samples.
+"""
+
+class Histogram:
+    """Running histogram of Y with conditional sums of Φ on fixed bins over y_range."""
+
+    def __init__(self, y_range, N_bins):
+        self.y_range = (float(y_range[0]), float(y_range[1]))
+        self.N_bins = int(N_bins)
+        self.edges = np.linspace(self.y_range[0], self.y_range[1], self.N_bins+1)
+        self.counts = np.zeros(self.N_bins)
+        self.Φ_sum = np.zeros(self.N_bins)
+
+    @property
+    def y(self):
+        """Bin centres."""
+        return .5*(self.edges[1:] + self.edges[:-1])
+
+    @property
+    def dy(self):
+        return self.edges[1] - self.edges[0]
+
+    @property
+    def samples(self):
+        """Number of samples which fell inside y_range."""
+        return np.sum(self.counts)
+
+    def bin(self, Y):
+        """Bin index of each sample of Y (as np.histogram), N_bins for those outside y_range."""
+        Y = np.asarray(Y, dtype=np.float64).ravel()
+        lo, hi = self.y_range
+        keep = (Y >= lo) & (Y <= hi)
+        i = np.where(keep, (Y - lo)*(self.N_bins/(hi - lo)), 0).astype(np.intp)
+        i[i == self.N_bins] -= 1
+        # Correct for round-off in the scaling, so samples match the edges exactly
+        i -= (Y < self.edges[i])
+        i += (Y >= self.edges[np.minimum(i+1, self.N_bins)]) & (i < self.N_bins-1)
+        i[~keep] = self.N_bins
+        return i
+
+    def add(self, Y, Φ=None):
+        """Add a chunk of samples Y, with the corresponding samples Φ if given."""
+        return self.add_bins(self.bin(Y), Φ)
+
+    def add_bins(self, i, Φ=None):
+        """Add samples by their bin indices i = bin(Y), with the corresponding samples Φ if given."""
+        i = np.ravel(i)
+        # The extra bin N_bins collects the samples outside y_range
+        self.counts += np.bincount(i, minlength=self.N_bins+1)[:self.N_bins]
+        if Φ is not None:
+            Φ = np.asarray(Φ, dtype=np.float64).ravel()
+            self.Φ_sum += np.bincount(i, weights=Φ, minlength=self.N_bins+1)[:self.N_bins]
+        return self
+
+    def compatible(self, other):
+        return self.N_bins == other.N_bins and self.y_range == other.y_range
+
+    def __iadd__(self, other):
+        """Merge the counts of another histogram on the same bins."""
+        if not self.compatible(other):
+            raise ValueError("Histograms must have the same y_range and N_bins to be merged")
+        self.counts += other.counts
+        self.Φ_sum += other.Φ_sum
+        return self
+
+    def __add__(self, other):
+        return self.copy().__iadd__(other)
+
+    def __radd__(self, other):
+        # Allows sum([H_1, H_2, ...])
+        if other == 0:
+            return self.copy()
+        return self.__add__(other)
+
+    def copy(self):
+        H = Histogram(self.y_range, self.N_bins)
+        H.counts[:] = self.counts
+        H.Φ_sum[:] = self.Φ_sum
+        return H
+
+    def allreduce(self, comm):
+        """Sum, in place, the histograms held by each rank of the MPI communicator comm."""
+        allreduce(self.counts, comm)
+        allreduce(self.Φ_sum, comm)
+        return self
+
+    def save(self, filename):
+        """Save the histogram state to filename (.npz, or .h5/.hdf5)."""
+        state = {'y_range':np.array(self.y_range), 'counts':self.counts, 'Φ_sum':self.Φ_sum}
+        if filename.endswith(('.h5', '.hdf5')):
+            with h5py.File(filename, mode='w') as file:
+                for key, value in state.items():
+                    file[key] = value
+        else:
+            np.savez(filename, **state)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a histogram saved by Histogram.save."""
+        if filename.endswith(('.h5', '.hdf5')):
+            with h5py.File(filename, mode='r') as file:
+                state = {key:file[key][...] for key in file.keys()}
+        else:
+            with np.load(filename) as file:
+                state = {key:file[key] for key in file.files}
+        H = cls(state['y_range'], len(state['counts']))
+        H.counts[:] = state['counts']
+        H.Φ_sum[:] = state['Φ_sum']
+        return H
+
+    def density(self):
+        """f_Y(y) normalised over y_range."""
+        return self.counts/(self.samples*self.dy)
+
+    def expectation(self):
+        """E{Φ|Y=y}, nan in empty bins."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.Φ_sum/self.counts
+
+    def weighted_density(self):
+        """E{Φ|Y=y} f_Y(y)."""
+        return self.Φ_sum/(self.samples*self.dy)
+
+def stacked_counts(Y, y_range, N_bins):
+    """Counts of shape (T, N_bins) of each slice Y[t] of Y, shape (T, ...), on the same bins."""
+    Y = np.asarray(Y)
+    return stacked_bincount(Histogram(y_range, N_bins).bin(Y).reshape(Y.shape[0], -1), N_bins)
+
+def stacked_bincount(i, N_bins):
+    """
+    Counts of shape (T, N_bins) from the bin indices i, shape (T, M), of Histogram.bin.
+    The indices of slice t are offset, in place, by t*(N_bins+1), the extra bin
+    collecting samples outside y_range, so that all T histograms are found by a
+    single bincount.
+    """
+    T = i.shape[0]
+    i += (N_bins+1)*np.arange(T)[:, None]
+    counts = np.bincount(i.ravel(), minlength=T*(N_bins+1)).reshape(T, N_bins+1)
+    return counts[:, :N_bins].astype(np.float64)
+
+def joint_counts(i, j, N_i, N_j):
+    """
+    Counts of shape (N_i, N_j) of the pairs of bin indices (i, j), as returned by
+    Histogram.bin of two histograms with N_i and N_j bins, found by a single bincount.
+    """
+    k = np.ravel(i)*(N_j+1) + np.ravel(j)
+    counts = np.bincount(k, minlength=(N_i+1)*(N_j+1)).reshape(N_i+1, N_j+1)
+    return counts[:N_i, :N_j].astype(np.float64)
+
+def stacked_density(Y, y_range, N_bins, counts=None):
+    """f_Y of each slice Y[t] of Y, shape (T, ...), on the same bins; or of given stacked counts."""
+    if counts is None:
+        counts = stacked_counts(Y, y_range, N_bins)
+    dy = (y_range[1] - y_range[0])/N_bins
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts/(np.sum(counts, axis=1, keepdims=True)*dy)
+
+def allreduce(X, comm):
+    """Sum the array X in place over all ranks of the MPI communicator comm."""
+    from mpi4py import MPI
+    comm.Allreduce(MPI.IN_PLACE, X, op=MPI.SUM)
+    return X
+
+def global_range(Y, comm=None):
+    """(min, max) of the samples Y, taken over all ranks of comm if given."""
+    Y = np.asarray(Y)
+    lo = np.min(Y) if Y.size else np.inf
+    hi = np.max(Y) if Y.size else -np.inf
+    return reduce_range(lo, hi, comm)
+
+def reduce_range(lo, hi, comm=None):
+    """(min lo, max hi) over all ranks of comm if given."""
+    if comm is not None:
+        from mpi4py import MPI
+        lo = comm.allreduce(lo, op=MPI.MIN)
+        hi = comm.allreduce(hi, op=MPI.MAX)
+    return (lo, hi)
+
+def merge(filenames):
+    """Sum the histograms saved in filenames, e.g. one per ensemble shard."""
+    return sum(Histogram.load(filename) for filename in filenames)
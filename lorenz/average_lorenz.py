@@ -0,0 +1,165 @@
+"""Time-averaged joint probability density of (Y1,Y2) over a Lorenz (1963) trajectory,
+i.e. the density with respect to the invariant measure of the attractor. The jacobian
+densities of chunks of the trajectory are summed on a fixed global grid by a pool of
+processes and accumulated with bounded memory, reporting the distance between the
+averages over earlier and later samples as they are added."""
+
+
+import numpy as np
+import multiprocessing
+import matplotlib.pyplot as plt
+from scipy.integrate import solve_ivp
+import helper as lorenz
+
+def trajectory_segments(nt=10**6, tend=4*10**4, a0=(1.0,1.0,8.0), segment=10**4, transient=0, s=10, r=28, b=8/3):
+    """
+    Yield the states, shape (m,3), of the trajectory sampled at nt+1 equally spaced
+    times in segments of at most segment samples, each integrated from the end of
+    the last, discarding the first transient samples.
+    """
+    t = np.linspace(0,tend,nt+1)
+    a_n = np.array(a0)
+    for n in range(0, nt, segment):
+        t_n = t[n:min(n+segment,nt)+1]
+        sol = solve_ivp(lorenz.tangent, t_n[[0,-1]], a_n, t_eval=t_n, args=(s,r,b))
+        a_n = sol.y[:,-1]
+        # The last sample starts the next segment
+        a = sol.y.T if n+segment >= nt else sol.y.T[:-1]
+        yield a[max(0, transient-n):]
+
+def global_grid(n1=500, n2=500, scale=1.0, s=10, r=28, b=8/3):
+    """Grid y1_, y2_ covering the density for all states within Xlim, Ylim and Zlim."""
+    a_max = [max(np.abs(lim)) for lim in (lorenz.Xlim(s,r,b), lorenz.Ylim(s,r,b), lorenz.Zlim(s,r,b))]
+    y1_max, y2_max = lorenz.Ybounds(a_max, r=r, b=b)
+    y1_ = np.linspace(-scale*y1_max, scale*y1_max, n1)
+    y2_ = np.linspace(-scale*y2_max, scale*y2_max, n2)
+    return y1_, y2_
+
+def partial_sum(args):
+    """Sum of calc_jac over the states a, evaluated chunk states at a time in the same buffers."""
+    a, y1_, y2_, chunk, r, b = args
+    y = np.meshgrid(y1_, y2_, indexing='ij')
+    J_sum = np.zeros(y[0].shape)
+    out = np.empty((min(chunk, len(a)),) + y[0].shape)
+    work = lorenz.jac_work(out.shape)
+    for n in range(0, len(a), chunk):
+        m = len(a[n:n+chunk])
+        if m < len(out):
+            # The last, shorter, chunk
+            out = out[:m]
+            work = {key:w[:m] for key, w in work.items()}
+        J_sum += np.sum(lorenz.calc_jac(y, a[n:n+chunk], r=r, b=b, out=out, work=work), axis=0)
+    return J_sum, len(a)
+
+class PDFAverage:
+    """
+    Running time average of the density J = calc_jac(y,a) on the fixed grid y1_, y2_.
+
+    Convergence is measured by the L1 distance between the averages over the samples
+    before and after a checkpoint taken after M samples, N/4 < M <= N/2 when N have
+    been added. Checkpoints are taken each time the number of samples doubles, so at
+    most a few copies of the grid are held.
+    """
+
+    def __init__(self, y1_, y2_):
+        self.y1 = np.asarray(y1_)
+        self.y2 = np.asarray(y2_)
+        self.J_sum = np.zeros((len(self.y1), len(self.y2)))
+        self.samples = 0
+        # (J_sum, samples) at each checkpoint still needed
+        self.checkpoints = []
+        # (samples, L1 distance between the averages either side of the checkpoint)
+        self.history = []
+
+    @property
+    def dA(self):
+        return (self.y1[1] - self.y1[0])*(self.y2[1] - self.y2[0])
+
+    def density(self):
+        return self.J_sum/self.samples
+
+    def add_sum(self, J_sum, samples):
+        """Add the sum J_sum of the densities of a number of samples."""
+        if samples == 0:
+            return self
+        self.J_sum += J_sum
+        self.samples += samples
+
+        N = self.samples
+        if not self.checkpoints or N >= 2*self.checkpoints[-1][1]:
+            self.checkpoints.append((self.J_sum.copy(), N))
+        while len(self.checkpoints) > 1 and self.checkpoints[1][1] <= N/2:
+            self.checkpoints.pop(0)
+
+        J_M, M = self.checkpoints[0]
+        if M <= N/2:
+            f_1 = J_M/M
+            f_2 = (self.J_sum - J_M)/(N - M)
+            self.history.append((N, np.sum(np.abs(f_1 - f_2))*self.dA))
+        return self
+
+    def add(self, a, chunk=32, r=28, b=8/3):
+        """Add the states a, shape (m,3), in this process."""
+        a = np.reshape(a, (-1,3))
+        return self.add_sum(*partial_sum((a, self.y1, self.y2, chunk, r, b)))
+
+    def save(self, filename):
+        np.savez(filename, y1=self.y1, y2=self.y2, J_sum=self.J_sum, samples=self.samples, history=np.array(self.history),
+                 checkpoint_sums=np.array([J for J, M in self.checkpoints]), checkpoint_samples=np.array([M for J, M in self.checkpoints]))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as file:
+            F = cls(file['y1'], file['y2'])
+            F.J_sum[:] = file['J_sum']
+            F.samples = int(file['samples'])
+            F.history = [tuple(h) for h in file['history']]
+            F.checkpoints = [(J, int(M)) for J, M in zip(file['checkpoint_sums'], file['checkpoint_samples'])]
+        return F
+
+def time_average(segments, y1_, y2_, batch=256, chunk=32, processes=None, r=28, b=8/3, average=None):
+    """
+    Accumulate the states yielded by segments into a PDFAverage on the grid y1_, y2_
+    (or into average if given). Batches of states are summed by a pool of processes
+    (all cores if processes is None), at most 2*processes batches at a time.
+    """
+    if average is None:
+        average = PDFAverage(y1_, y2_)
+    processes = processes or multiprocessing.cpu_count()
+    window = 2*processes
+
+    with multiprocessing.Pool(processes) as pool:
+        for a in segments:
+            tasks = [(a[n:n+batch], average.y1, average.y2, chunk, r, b) for n in range(0, len(a), batch)]
+            for w in range(0, len(tasks), window):
+                for J_sum, samples in pool.imap(partial_sum, tasks[w:w+window]):
+                    average.add_sum(J_sum, samples)
+            if average.history:
+                print('Samples = %d, |f_1 - f_2|_1 = %.3e'%average.history[-1])
+    return average
+
+
+if __name__ == "__main__":
+
+    y1_, y2_ = global_grid(n1=500, n2=500)
+    segments = trajectory_segments(nt=10**6, tend=4*10**4, transient=10**3)
+    average = time_average(segments, y1_, y2_)
+    average.save('lorenz_pdf_average.npz')
+
+    samples, change = np.array(average.history).T
+
+    plt.figure(figsize=(6,5))
+    plt.subplot(2,1,1)
+    y1, y2 = np.meshgrid(y1_, y2_, indexing='ij')
+    plt.pcolormesh(y1, y2, average.density(), cmap='pink_r')
+    plt.xlabel('$y_{1}$')
+    plt.ylabel('$y_{2}$')
+    lorenz.label_subplot('$(a)$')
+
+    plt.subplot(2,1,2)
+    plt.loglog(samples, change, 'k')
+    plt.xlabel('Samples')
+    plt.ylabel(r'$\|f_{1} - f_{2}\|_{1}$')
+    lorenz.label_subplot('$(b)$')
+    plt.tight_layout()
+    plt.show()
@@ -55,8 +55,9 @@ d2 = (y2_max - y2_min)/n2
 [y1,y2] = np.meshgrid(y1_,y2_, indexing='ij')
 
 # Calculate the jacobian in terms of y1 and y2
-J = lorenz.calc_jac([y1, y2], a[i,:])
-Ed1dt, Ed2dt = lorenz.calc_dydt([y1,y2],a[i,:])
+frame = lorenz.LorenzPDFFrame(a[i,:], [y1, y2])
+J = frame.J
+Ed1dt, Ed2dt = frame.dydt
 
 # Ignore nan = 0**(-1)
 with np.errstate(invalid=lorenz.debug_level):
@@ -1,5 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from functools import cached_property
 
 """ Helper routines to investigate the system
 Y1 = c0.a0(t).cos(k.X1).sin(pi.X2)
@@ -31,8 +32,39 @@ def wavenumber(b=8/3):
     """wavenumber k for a given parameter b"""
     return np.sqrt( (4-b)*np.pi**2/b )
 
+def states(a, X):
+    """
+    Return a state a, shape (3,), unchanged or stacked states, shape (nt,3), as
+    components a[0], a[1], a[2] of shape (nt,1,..,1) which broadcast against the
+    grid X[0] so that every field evaluated from them has shape (nt,) + X[0].shape.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    if a.ndim == 1:
+        return a
+    return a.T.reshape((3, len(a)) + (1,)*np.ndim(X[0]))
+
+def chunked(func, X, a, chunk=32, **kwargs):
+    """
+    Evaluate func(X, a[n:n+chunk], **kwargs) for stacked states a, shape (nt,3), chunk
+    states at a time so that temporaries are bounded by chunk*X[0].size, filling the
+    output(s) of shape (nt,) + X[0].shape.
+    """
+    a = np.reshape(a, (-1,3))
+    out = None
+    for n in range(0, len(a), chunk):
+        f = func(X, a[n:n+chunk], **kwargs)
+        single = isinstance(f, np.ndarray)
+        if single:
+            f = [f]
+        if out is None:
+            out = [np.empty((len(a),) + np.shape(f_i)[1:]) for f_i in f]
+        for o, f_i in zip(out, f):
+            o[n:n+chunk] = f_i
+    return out[0] if single else out
+
 def field(X, a, s=10,r=28,b=8/3):
-    """Return the vertical velocity and buoyancy field for a given state a(t)"""
+    """Return the vertical velocity and buoyancy field for a given state a(t), or stacked states"""
+    a = states(a, X)
     k = wavenumber(b)
     c = calc_coeffs(r=r,b=b)
 
@@ -44,7 +76,8 @@ def field(X, a, s=10,r=28,b=8/3):
     return [Y0, Y1]
 
 def jacobian(X, a, s=10,r=28,b=8/3):
-    """Return the jacobian field for a given state a(t) in terms of X"""
+    """Return the jacobian field for a given state a(t), or stacked states, in terms of X"""
+    a = states(a, X)
     k = wavenumber(b)
     c = calc_coeffs(r=r,b=b)
 
@@ -58,10 +91,11 @@ def jacobian(X, a, s=10,r=28,b=8/3):
     return J
 
 def jac(y, a, r=28,b=8/3, domain='D1'):
-    """Return the jacobian field for a given state a(t) in terms of y"""
+    """Return the jacobian field for a given state a(t), or stacked states, in terms of y"""
     # Note that J(y) is needed in order to construct the probability density as
     # a function of y
     
+    a = states(a, y)
     k = wavenumber(b)
     c = calc_coeffs(r=r,b=b)
 
@@ -108,9 +142,84 @@ def jac(y, a, r=28,b=8/3, domain='D1'):
     return J*k / np.pi
 
 
-def calc_jac(y,A, r=28, b=8/3):
-    """Calculate jacobian in terms of Y by combining jacobians for D1 and D2"""
-    return 2*(jac(y,A,r=r, b=b, domain='D1') + jac(y,A,r=r,b=b, domain='D2'))
+def jac_work(shape):
+    """Scratch arrays for jacs and calc_jac on grids of the given shape."""
+    work = {key:np.empty(shape) for key in ('Q','P','S2','W','J')}
+    work['mask'] = np.empty(shape, dtype=bool)
+    return work
+
+def jacs(y, a, r=28, b=8/3, out=None, work=None):
+    """Return the jacobians [J_D1, J_D2] of jac for both subdomains in one pass.
+
+    The terms common to D1 and D2 (R, dRd2, sqrt(1-4R)) are computed once and,
+    as the dC/dR terms cancel in dXd1*dZd2 - dZd1*dXd2, the jacobian reduces to
+    J = |dRd2| / (2 pi^2 |c0.a0| S^2 P sqrt(1-S^2) sqrt(1-C^2)), P = sqrt(1-4R),
+    which is evaluated with in-place ufuncs. If given, out = [J_D1, J_D2] are
+    filled and work = jac_work(shape) used as scratch, so nothing is allocated.
+    """
+    a = states(a, y)
+    c = calc_coeffs(r=r,b=b)
+    shape = np.broadcast_shapes(np.shape(y[0]), np.shape(y[1]), np.shape(a[0]))
+    if out is None:
+        out = [np.empty(shape), np.empty(shape)]
+    if work is None:
+        work = jac_work(shape)
+    Q, P, S2, W, mask = work['Q'], work['P'], work['S2'], work['W'], work['mask']
+
+    # R = β Q**2 and dRd2 = -β Q as in jac
+    α = c[1]*a[1]/(c[0]*a[0])
+    β = 1/(c[2]*a[2])**2
+
+    with np.errstate(invalid=debug_level, divide=debug_level):
+        np.multiply(y[0], α, out=Q)
+        np.subtract(Q, y[1], out=Q)
+
+        # P = sqrt(1-4R)
+        np.multiply(Q, Q, out=P)
+        P *= -4*β
+        P += 1
+        np.sqrt(P, out=P)
+
+        # Q := |dRd2| / (2 pi^2 |c0.a0|)
+        np.abs(Q, out=Q)
+        Q *= β/(2*np.pi**2*np.abs(c[0]*a[0]))
+
+        for J, sign in zip(out, [-1, 1]):
+            # S^2 = (1 + sign P)/2, W = sqrt(1-S^2)
+            np.multiply(P, sign/2, out=S2)
+            S2 += 1/2
+            np.subtract(1, S2, out=W)
+            np.sqrt(W, out=W)
+
+            # J := sqrt(1-C^2), C = y1/(c0.a0.S)
+            np.multiply(y[0], y[0], out=J)
+            J /= (c[0]*a[0])**2
+            J /= S2
+            np.subtract(1, J, out=J)
+            np.sqrt(J, out=J)
+
+            J *= W
+            J *= S2
+            J *= P
+            np.divide(Q, J, out=J)
+
+            # On the curves S=1, C=1 jac finds 0*inf = nan rather than inf
+            np.isfinite(J, out=mask)
+            np.logical_not(mask, out=mask)
+            np.copyto(J, 0., where=mask)
+    return out
+
+def calc_jac(y,A, r=28, b=8/3, out=None, work=None):
+    """Calculate jacobian in terms of Y by combining jacobians for D1 and D2, into out if given"""
+    if out is None:
+        J1, J2 = jacs(y,A,r=r,b=b,work=work)
+        return 2*(J1 + J2)
+    if work is None:
+        work = jac_work(np.shape(out))
+    J1, J2 = jacs(y,A,r=r,b=b,out=[out, work['J']],work=work)
+    out += J2
+    out *= 2
+    return out
 
 def Kmax(s=10, r=28, b=8/3):
     """Useful bounds for plotting."""
@@ -141,9 +250,17 @@ def Ylim(s=10, r=28, b=8/3):
     J = Jmax(s,r,b)
     return [-np.sqrt(J), np.sqrt(J)]
 
-def E(y, a, G):
-    """Expectation of G. Values of G for branches D1 and D2 given in list G = [G[0],G[1]]."""
-    return jac(y,a, domain='D1')*G[0] + jac(y,a, domain='D2')*G[1]
+def Ybounds(a, r=28, b=8/3):
+    """Bounds [y1_max, y2_max] on |Y1|, |Y2| over all states in a, shape (3,) or (nt,3)."""
+    c = calc_coeffs(r=r,b=b)
+    a = np.abs(np.reshape(a, (-1,3)))
+    return [c[0]*np.max(a[:,0]), np.max(c[1]*a[:,1] + c[2]*a[:,2]/2)]
+
+def E(y, a, G, J=None):
+    """Expectation of G. Values of G for branches D1 and D2 given in list G = [G[0],G[1]], jacobians J = jacs(y,a) if precomputed."""
+    if J is None:
+        J = jacs(y,a)
+    return J[0]*G[0] + J[1]*G[1]
 
 def rhs(y, c, a):
     # Let S=sin(pi.X2)
@@ -160,39 +277,123 @@ def inversion(y, c, a, R, domain='D1'):
     C = y[0] / (c[0]*a[0]) / S
     return [C,S]
     
-def calc_dydt(y, a, r=28, b=8/3):
-    k = np.sqrt( (4-b)*np.pi**2/b )
-    c = calc_coeffs(r)
-
-    # Get tangent vector
-    dYdt = tangent(0,a)
-
-    R = rhs(y,c,a) # 1/(c3*A[2])**2 * (c2*A[1]/(c1*A[0])*Y[0] - Y[1])**2
-
-    C,S = inversion(y,c,a,R, domain='D1')
-    # Zh   = np.sqrt( (1 + sign*np.sqrt(1-4*P))/2)
-    # Xh   = Y[0] / (c[0]*A[0]) / Zh
-
-    d1dt = [y[0]*dYdt[0]/a[0]]
-    d2dt = [0*d1dt[0]]
+def branch_d2dt(y, S, thresh, a, dYdt, r=28):
+    """Conditional d/dt of Y2 on the branch with inversion S, either side of y2 = thresh."""
+    with np.errstate(invalid=debug_level):
+        dS = 1/r/np.pi*dYdt[2]*2*S*np.sqrt(1-S**2)
+    d2dt = thresh*dYdt[1]/a[1]
+    # 0 where thresh is nan
+    return np.where(y[1]>=thresh, d2dt + dS, np.where(y[1]<thresh, d2dt - dS, 0))
 
-    thresh = np.sqrt(2)/np.pi/r*a[1]*C*S
-    js = y[1]>=thresh
-    d2dt[0][js] = thresh[js]*dYdt[1]/a[1] + 1/r/np.pi*dYdt[2]*2*S[js]*np.sqrt(1-S[js]**2)
-    js = y[1]<thresh
-    d2dt[0][js] = thresh[js]*dYdt[1]/a[1] - 1/r/np.pi*dYdt[2]*2*S[js]*np.sqrt(1-S[js]**2)
-    
-    C,S = inversion(y,c,a,R, domain='D2')
-    # Zh   = np.sqrt( (1 + sign*np.sqrt(1-4*P))/2)
-    # Xh   = y[0] / (c[0]*A[0]) / Zh
-    d1dt += [y[0]*dYdt[0]/a[0]]
-    d2dt += [0*d1dt[0]]
-    js = y[1]>=thresh
-    d2dt[1][js] = thresh[js]*dYdt[1]/a[1] + 1/r/np.pi*dYdt[2]*2*S[js]*np.sqrt(1-S[js]**2)
-    js = y[1]<thresh
-    d2dt[1][js] = thresh[js]*dYdt[1]/a[1] - 1/r/np.pi*dYdt[2]*2*S[js]*np.sqrt(1-S[js]**2)
-
-    return E(y, a, d1dt), E(y, a, d2dt)
+def calc_dydt(y, a, r=28, b=8/3):
+    """Conditional expectations [E{dY1/dt|y} f, E{dY2/dt|y} f] for the state a(t), or stacked states."""
+    return LorenzPDFFrame(a, y, r=r, b=b).dydt
+
+
+class LorenzPDFFrame:
+    """
+    Probability density of (Y1,Y2) on the grid y = [y1,y2] for a state a(t), or for
+    stacked states a, shape (nt,3), in which case every array has shape (nt,n1,n2).
+    The jacobians of both branches (from a single call of jacs, as calc_jac), J,
+    R, the inversions C,S and the conditional velocities are computed on first
+    use and memoized, so that each is built once and then shared by every
+    quantity that depends on it.
+    """
+
+    def __init__(self, a, y, s=10, r=28, b=8/3):
+        self.A = a
+        self.a = states(a, y)
+        self.y = y
+        self.s = s
+        self.r = r
+        self.b = b
+
+    @cached_property
+    def c(self):
+        return calc_coeffs(r=self.r, b=self.b)
+
+    @cached_property
+    def Q(self):
+        """c1.a1/(c0.a0).y1 - y2, such that R = Q**2/(c2.a2)**2"""
+        a, c = self.a, self.c
+        return c[1]*a[1]/(c[0]*a[0])*self.y[0] - self.y[1]
+
+    @cached_property
+    def R(self):
+        return self.Q**2/(self.c[2]*self.a[2])**2
+
+    @cached_property
+    def P(self):
+        """sqrt(1-4R), nan outside the support of the density"""
+        with np.errstate(invalid=debug_level):
+            return np.sqrt(1-4*self.R)
+
+    def _inversion(self, sign):
+        with np.errstate(invalid=debug_level, divide=debug_level):
+            S = np.sqrt((1 + sign*self.P)/2)
+            C = self.y[0] / (self.c[0]*self.a[0]) / S
+        return [C, S]
+
+    @cached_property
+    def inversion_D1(self):
+        return self._inversion(-1)
+
+    @cached_property
+    def inversion_D2(self):
+        return self._inversion(1)
+
+    def inversion(self, domain='D1'):
+        """[C,S] on the branch D1 or D2, as inversion(y,c,a,R,domain)"""
+        return self.inversion_D1 if domain == 'D1' else self.inversion_D2
+
+    @cached_property
+    def jacobians(self):
+        """[J_D1, J_D2], as jacs(y,a,r,b)"""
+        return jacs(self.y, self.A, r=self.r, b=self.b)
+
+    @property
+    def jac_D1(self):
+        return self.jacobians[0]
+
+    @property
+    def jac_D2(self):
+        return self.jacobians[1]
+
+    def jac(self, domain='D1'):
+        """Jacobian of the branch D1 or D2, as jac(y,a,r,b,domain)"""
+        return self.jac_D1 if domain == 'D1' else self.jac_D2
+
+    @cached_property
+    def J(self):
+        """Jacobian in terms of Y, as calc_jac(y,a,r,b)"""
+        return 2*(self.jac_D1 + self.jac_D2)
+
+    @cached_property
+    def dYdt(self):
+        return tangent(0, self.a, s=self.s, r=self.r, b=self.b)
+
+    @cached_property
+    def dydt(self):
+        """(Ed1dt, Ed2dt) as calc_dydt(y,a,r,b)"""
+        y, a, dYdt = self.y, self.a, self.dYdt
+        J = self.jacobians
+
+        # Threshold taken from the D1 inversion on both branches
+        C,S = self.inversion_D1
+        thresh = np.sqrt(2)/np.pi/self.r*a[1]*C*S
+
+        d1dt = y[0]*dYdt[0]/a[0]
+        d2dt = [branch_d2dt(y, self.inversion_D1[1], thresh, a, dYdt, self.r),
+                branch_d2dt(y, self.inversion_D2[1], thresh, a, dYdt, self.r)]
+        return E(y, a, [d1dt, d1dt], J), E(y, a, d2dt, J)
+
+    @property
+    def Ed1dt(self):
+        return self.dydt[0]
+
+    @property
+    def Ed2dt(self):
+        return self.dydt[1]
 
 
 def plot_algebraic_curve(a, n=500, r=28, ocol='k', icol='k', **kwargs):
@@ -0,0 +1,99 @@
+"""Render the joint probability density of (Y1,Y2) and its conditional velocities
+at every, or every stride-th, sample of a Lorenz (1963) trajectory. Frames are
+evaluated in batches by a pool of processes and streamed to an HDF5 file with
+datasets of shape (nt, n1, n2) on a fixed grid, from which a movie is encoded."""
+
+
+import numpy as np
+import multiprocessing
+import h5py
+from scipy.integrate import solve_ivp
+import helper as lorenz
+
+def trajectory(nt=5000, tend=200, a0=(1.0,1.0,8.0), s=10, r=28, b=8/3):
+    """Times t and states a, shape (nt+1,3), sampled as in fig_lorenz.py."""
+    t = np.linspace(0,tend,nt+1)
+    sol = solve_ivp(lorenz.tangent, np.array([0,tend]), np.array(a0), t_eval=t, args=(s,r,b))
+    return t, sol.y.T
+
+def grid(a, n1=1000, n2=1000, scale=1.2, r=28, b=8/3):
+    """Grid y1_, y2_ covering the support of the density for every state in a."""
+    y1_max, y2_max = lorenz.Ybounds(a, r=r, b=b)
+    y1_ = np.linspace(-scale*y1_max, scale*y1_max, n1)
+    y2_ = np.linspace(-scale*y2_max, scale*y2_max, n2)
+    return y1_, y2_
+
+def render_batch(args):
+    """J, Ed1dt and Ed2dt, each of shape (len(a), n1, n2), for a batch of states a."""
+    a, y1_, y2_, s, r, b, dtype = args
+    y = np.meshgrid(y1_, y2_, indexing='ij')
+
+    # All states of the batch are broadcast against the grid together
+    frame = lorenz.LorenzPDFFrame(a, y, s=s, r=r, b=b)
+    Ed1dt, Ed2dt = frame.dydt
+    return frame.J.astype(dtype), Ed1dt.astype(dtype), Ed2dt.astype(dtype)
+
+def render(filename, t, a, n1=1000, n2=1000, stride=1, batch=4, processes=None, scale=1.2, s=10, r=28, b=8/3, dtype=np.float32, compression=None):
+    """
+    Write the frames of the states a[::stride] to filename as datasets J, Ed1dt and
+    Ed2dt of shape (nt, n1, n2), alongside t, a, y1 and y2. Batches of frames are
+    evaluated by a pool of processes (all cores if processes is None) and at most
+    2*processes batches are held in memory before being written.
+    """
+    t = t[::stride]
+    a = a[::stride]
+    nt = len(a)
+    y1_, y2_ = grid(a, n1, n2, scale, r=r, b=b)
+
+    tasks = [(a[n:n+batch], y1_, y2_, s, r, b, dtype) for n in range(0, nt, batch)]
+    processes = processes or multiprocessing.cpu_count()
+    window = 2*processes
+
+    with h5py.File(filename, mode='w') as file:
+        file['t'] = t
+        file['a'] = a
+        file['y1'] = y1_
+        file['y2'] = y2_
+        dsets = [file.create_dataset(key, shape=(nt,n1,n2), dtype=dtype, chunks=(1,n1,n2), compression=compression)
+                 for key in ('J','Ed1dt','Ed2dt')]
+
+        n = 0
+        with multiprocessing.Pool(processes) as pool:
+            for w in range(0, len(tasks), window):
+                for fields in pool.imap(render_batch, tasks[w:w+window]):
+                    m = len(fields[0])
+                    for dset, field in zip(dsets, fields):
+                        dset[n:n+m] = field
+                    n += m
+                print('Frames = %d/%d'%(n,nt))
+
+def animate(filename, movie='lorenz_pdf.mp4', fps=30, clim=(0,0.06)):
+    """Encode the density J of each frame in filename as a movie, reading one frame at a time."""
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
+
+    with h5py.File(filename, mode='r') as file:
+        t, J = file['t'], file['J']
+        y1, y2 = np.meshgrid(file['y1'][...], file['y2'][...], indexing='ij')
+
+        fig = plt.figure(figsize=(6,5))
+        mesh = plt.pcolormesh(y1, y2, J[0], cmap='pink_r', vmin=clim[0], vmax=clim[1])
+        title = plt.title('$t = %.2f$'%t[0])
+        plt.xlabel('$y_{1}$')
+        plt.ylabel('$y_{2}$')
+
+        def update(n):
+            mesh.set_array(J[n].ravel())
+            title.set_text('$t = %.2f$'%t[n])
+            return mesh, title
+
+        anim = animation.FuncAnimation(fig, update, frames=len(t), blit=False)
+        anim.save(movie, fps=fps)
+        plt.close(fig)
+
+
+if __name__ == "__main__":
+
+    t, a = trajectory(nt=5000, tend=200)
+    render('lorenz_pdf.h5', t, a, n1=1000, n2=1000, stride=1)
+    animate('lorenz_pdf.h5')
@@ -0,0 +1,60 @@
+import numpy as np
+import scipy.sparse as sp
+
+""" Regridding routines to move data Y(t,z) between grids in z
+using an interpolation matrix P, built once per pair of grids,
+such that Y(t,z_out) = P Y(t,z).
+"""
+
+_cache = {}
+
+def chebyshev_weights(M):
+    """Barycentric weights for the M Gauss-Chebyshev points used by Dedalus."""
+    j = np.arange(M)
+    return (-1.)**j * np.sin((2*j+1)*np.pi/(2*M))
+
+def barycentric_matrix(z_out, z, w):
+    """Dense matrix evaluating the polynomial through (z,Y) at the points z_out."""
+    dz = z_out[:,None] - z[None,:]
+    i,j = np.nonzero(dz == 0)
+    dz[i,j] = 1
+    P = w[None,:]/dz
+    P /= np.sum(P, axis=1, keepdims=True)
+    P[i,:] = 0
+    P[i,j] = 1
+    return P
+
+def linear_matrix(z_out, z):
+    """Sparse matrix equivalent to np.interp(z_out, z, Y), constant beyond the ends of z."""
+    n   = np.clip(np.searchsorted(z, z_out, side='right') - 1, 0, len(z)-2)
+    s   = np.clip((z_out - z[n])/(z[n+1] - z[n]), 0, 1)
+    row = np.arange(len(z_out))
+    P   = sp.csr_matrix((np.concatenate((1-s, s)), (np.concatenate((row, row)), np.concatenate((n, n+1)))),
+                        shape=(len(z_out), len(z)))
+    return P
+
+def interpolation_matrix(z_out, z, method='linear'):
+    """
+    Return the (cached) interpolation matrix from z onto z_out. The method is
+    'linear', or 'chebyshev' for spectral evaluation from the Gauss-Chebyshev grid z.
+    """
+    z_out = np.asarray(z_out, dtype=np.float64)
+    z     = np.asarray(z, dtype=np.float64)
+
+    key = (z_out.tobytes(), z.tobytes(), method)
+    if key not in _cache:
+        if method == 'linear':
+            _cache[key] = linear_matrix(z_out, z)
+        elif method == 'chebyshev':
+            _cache[key] = barycentric_matrix(z_out, z, chebyshev_weights(len(z)))
+        else:
+            raise ValueError("method must be 'linear' or 'chebyshev'")
+    return _cache[key]
+
+def regrid(Y, z, z_out, method='linear', axis=-1):
+    """Interpolate Y from z onto z_out along the given axis in a single product."""
+    P = interpolation_matrix(z_out, z, method)
+    Y = np.moveaxis(np.asarray(Y), axis, 0)
+    s = Y.shape
+    Y = P @ Y.reshape(s[0], -1)
+    return np.moveaxis(Y.reshape((len(z_out),) + s[1:]), 0, axis)